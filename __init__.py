@@ -31,7 +31,8 @@ def lnurlp_renderer():
     return template_renderer(["lnurlp/templates"])
 
 from .lnurl import *  # noqa: F401,F403
-from .tasks import wait_for_paid_invoices
+from .sqlite import close_read_pool, start_enable_wal
+from .tasks import flush_pay_link_counters, wait_for_paid_invoices
 from .views import *  # noqa: F401,F403
 from .views_api import *  # noqa: F401,F403
 
@@ -42,7 +43,11 @@ scheduled_tasks: List[asyncio.Task] = []
 def lnurlp_stop():
     for task in scheduled_tasks:
         task.cancel()
+    close_read_pool()
 
 def lnurlp_start():
+    start_enable_wal()
     task = create_permanent_unique_task("lnurlp", wait_for_paid_invoices)
     scheduled_tasks.append(task)
+    task = create_permanent_unique_task("lnurlp_counters", flush_pay_link_counters)
+    scheduled_tasks.append(task)
@@ -1,23 +1,59 @@
-from typing import List, Optional, Union
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
 
 from lnbits.helpers import urlsafe_short_hash, insert_query, update_query
 
 from . import db
 from .models import CreatePayLinkData, LnurlpSettings, PayLink
 from .nostr.key import PrivateKey
+from .sqlite import read_fetchall, read_fetchone
+
+
+# settings are read on every pay link lookup but only change through the
+# functions below, so keep them in memory instead of re-querying each time
+_settings_cache: Optional[LnurlpSettings] = None
+
+# LNURL requests read the same link over and over under load, keep hydrated
+# links for a few seconds. Writes evict the entry they touch and bump its
+# generation, so a read that raced the write does not cache the old row.
+_pay_link_cache: Dict[str, Tuple[float, PayLink]] = {}
+_pay_link_cache_ttl = 5
+_pay_link_cache_size = 1024
+_pay_link_generations: Dict[str, int] = {}
+_pay_link_cache_generation = 0
+
+
+def _pay_link_generation(link_id: str) -> Tuple[int, int]:
+    return _pay_link_cache_generation, _pay_link_generations.get(link_id, 0)
+
+
+def _evict_pay_link(link_id: Optional[str] = None) -> None:
+    global _pay_link_cache_generation
+    if link_id:
+        _pay_link_cache.pop(link_id, None)
+        _pay_link_generations[link_id] = _pay_link_generations.get(link_id, 0) + 1
+    else:
+        _pay_link_cache.clear()
+        _pay_link_cache_generation += 1
 
 
 async def get_or_create_lnurlp_settings() -> LnurlpSettings:
+    global _settings_cache
+    if _settings_cache:
+        return _settings_cache
+
     row = await db.fetchone("SELECT * FROM lnurlp.settings LIMIT 1")
     if row:
-        return LnurlpSettings(**row)
+        settings = LnurlpSettings(**row)
     else:
         settings = LnurlpSettings(nostr_private_key=PrivateKey().hex())
         await db.execute(
             insert_query("lnurlp.settings", settings),
             (*settings.dict().values(),)
         )
-        return settings
+    _settings_cache = settings
+    return settings
 
 async def _pay_link_from_row(row: dict):
     pay_link = PayLink.from_row(row)
@@ -27,29 +63,29 @@ async def _pay_link_from_row(row: dict):
     return pay_link
 
 async def update_lnurlp_settings(settings: LnurlpSettings) -> LnurlpSettings:
+    global _settings_cache
     await db.execute(
         update_query("lnurlp.settings", settings, where=""),
         (*settings.dict().values(),)
     )
+    _settings_cache = settings
+    # cached links carry the configured domain
+    _evict_pay_link()
     return settings
 
 
 async def delete_lnurlp_settings() -> None:
+    global _settings_cache
     await db.execute("DELETE FROM lnurlp.settings")
+    _settings_cache = None
+    _evict_pay_link()
 
 
-async def get_pay_link_by_username(username: str) -> Optional[PayLink]:
-    row = await db.fetchone(
-        "SELECT * FROM lnurlp.pay_links WHERE username = ?", (username,)
-    )
-    return (await _pay_link_from_row(row)) if row else None
-
-
-async def create_pay_link(data: CreatePayLinkData) -> PayLink:
+async def create_pay_link(data: CreatePayLinkData) -> Optional[PayLink]:
 
     link_id = urlsafe_short_hash()[:6]
 
-    result = await db.execute(
+    row = await db.fetchone(
         """
         INSERT INTO lnurlp.pay_links (
             id,
@@ -72,6 +108,8 @@ async def create_pay_link(data: CreatePayLinkData) -> PayLink:
 
         )
         VALUES (?, ?, ?, ?, ?, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (username) WHERE username IS NOT NULL DO NOTHING
+        RETURNING *
         """,
         (
             link_id,
@@ -91,36 +129,62 @@ async def create_pay_link(data: CreatePayLinkData) -> PayLink:
             data.zaps,
         ),
     )
-    assert result
-
-    link = await get_pay_link(link_id)
-    assert link, "Newly created link couldn't be retrieved"
-    return link
+    # no row means the username is already taken
+    return (await _pay_link_from_row(row)) if row else None
 
 
 async def get_address_data(username: str) -> Optional[PayLink]:
-    row = await db.fetchone(
+    row = await read_fetchone(
         "SELECT * FROM lnurlp.pay_links WHERE username = ?", (username,)
     )
     return (await _pay_link_from_row(row)) if row else None
 
 
 async def get_pay_link(link_id: str) -> Optional[PayLink]:
-    row = await db.fetchone("SELECT * FROM lnurlp.pay_links WHERE id = ?", (link_id,))
-    return (await _pay_link_from_row(row)) if row else None
+    cached = _pay_link_cache.get(link_id)
+    if cached and cached[0] > time.monotonic():
+        # callers may mutate the link (e.g. its domain), hand out copies
+        return cached[1].copy()
+
+    generation = _pay_link_generation(link_id)
+    row = await read_fetchone(
+        "SELECT * FROM lnurlp.pay_links WHERE id = ?", (link_id,)
+    )
+    if not row:
+        return None
+    link = await _pay_link_from_row(row)
+    if generation != _pay_link_generation(link_id):
+        # written while we were reading, the row may predate the write
+        return link
+
+    _pay_link_cache.pop(link_id, None)
+    if len(_pay_link_cache) >= _pay_link_cache_size:
+        # drop the oldest entry
+        _pay_link_cache.pop(next(iter(_pay_link_cache)))
+    _pay_link_cache[link_id] = (time.monotonic() + _pay_link_cache_ttl, link)
+    return link.copy()
+
+
+_wallet_buckets = (1, 4, 16, 64)
 
 
 async def get_pay_links(wallet_ids: Union[str, List[str]]) -> List[PayLink]:
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
 
-    q = ",".join(["?"] * len(wallet_ids))
-    rows = await db.fetchall(
+    # pad the wallet list up to a fixed bucket size, so only a handful of
+    # distinct query texts exist and the statement cache keeps hitting
+    size = next(
+        (bucket for bucket in _wallet_buckets if bucket >= len(wallet_ids)),
+        -(-len(wallet_ids) // _wallet_buckets[-1]) * _wallet_buckets[-1],
+    )
+    q = ",".join(["?"] * size)
+    rows = await read_fetchall(
         f"""
         SELECT * FROM lnurlp.pay_links WHERE wallet IN ({q})
         ORDER BY Id
         """,
-        (*wallet_ids,),
+        (*wallet_ids, *[""] * (size - len(wallet_ids))),
     )
     pay_links = [PayLink.from_row(row) for row in rows]
     settings = await get_or_create_lnurlp_settings()
@@ -130,24 +194,98 @@ async def get_pay_links(wallet_ids: Union[str, List[str]]) -> List[PayLink]:
     return pay_links
 
 
+_pay_link_fields = (
+    "wallet",
+    "description",
+    "min",
+    "max",
+    "currency",
+    "comment_chars",
+    "webhook_url",
+    "webhook_headers",
+    "webhook_body",
+    "success_text",
+    "success_url",
+    "fiat_base_multiplier",
+    "username",
+    "zaps",
+    "served_meta",
+    "served_pr",
+)
+
+
+@lru_cache(maxsize=64)
+def _update_pay_link_query(fields: Tuple[str, ...]) -> str:
+    q = ", ".join([f"{field} = ?" for field in fields])
+    return f"UPDATE lnurlp.pay_links SET {q} WHERE id = ? RETURNING *"
+
+
 async def update_pay_link(link_id: str, **kwargs) -> Optional[PayLink]:
+    unknown = set(kwargs) - set(_pay_link_fields)
+    if unknown:
+        raise ValueError(f"Unknown pay link fields: {', '.join(sorted(unknown))}")
 
-    q = ", ".join([f"{field[0]} = ?" for field in kwargs.items()])
-    await db.execute(
-        f"UPDATE lnurlp.pay_links SET {q} WHERE id = ?", (*kwargs.values(), link_id)
+    # columns always go in the same order, so a given set of fields maps to
+    # one query text regardless of how the caller ordered its kwargs
+    fields = tuple(field for field in _pay_link_fields if field in kwargs)
+    row = await db.fetchone(
+        _update_pay_link_query(fields),
+        (*[kwargs[field] for field in fields], link_id),
     )
-    row = await db.fetchone("SELECT * FROM lnurlp.pay_links WHERE id = ?", (link_id,))
+    _evict_pay_link(link_id)
     return (await _pay_link_from_row(row)) if row else None
 
 
+# served counters are bumped on every LNURL request, collect them in memory
+# and let the flush task in tasks.py write them out in batches
+_pending_increments: Dict[str, Dict[str, int]] = {}
+
+
 async def increment_pay_link(link_id: str, **kwargs) -> Optional[PayLink]:
-    q = ", ".join([f"{field[0]} = {field[0]} + ?" for field in kwargs.items()])
-    await db.execute(
-        f"UPDATE lnurlp.pay_links SET {q} WHERE id = ?", (*kwargs.values(), link_id)
-    )
-    row = await db.fetchone("SELECT * FROM lnurlp.pay_links WHERE id = ?", (link_id,))
-    return (await _pay_link_from_row(row)) if row else None
+    unknown = set(kwargs) - {"served_meta", "served_pr"}
+    if unknown:
+        raise ValueError(f"Unknown pay link counters: {', '.join(sorted(unknown))}")
+
+    link = await get_pay_link(link_id)
+    if not link:
+        return None
+    pending = _pending_increments.setdefault(link_id, {})
+    for field, value in kwargs.items():
+        pending[field] = pending.get(field, 0) + value
+    return link
+
+
+async def flush_pay_link_increments() -> None:
+    global _pending_increments
+    if not _pending_increments:
+        return
+    pending, _pending_increments = _pending_increments, {}
+    rows = [
+        (counters.get("served_meta", 0), counters.get("served_pr", 0), link_id)
+        for link_id, counters in pending.items()
+    ]
+    try:
+        # one connection and one transaction for the whole batch
+        async with db.connect() as conn:
+            for row in rows:
+                await conn.execute(
+                    """
+                    UPDATE lnurlp.pay_links
+                    SET served_meta = served_meta + ?, served_pr = served_pr + ?
+                    WHERE id = ?
+                    """,
+                    row,
+                )
+    except BaseException:
+        # the transaction was rolled back (also when the flush task is cancelled
+        # halfway through), so retry everything on the next flush
+        for link_id, counters in pending.items():
+            merged = _pending_increments.setdefault(link_id, {})
+            for field, value in counters.items():
+                merged[field] = merged.get(field, 0) + value
+        raise
 
 
 async def delete_pay_link(link_id: str) -> None:
     await db.execute("DELETE FROM lnurlp.pay_links WHERE id = ?", (link_id,))
+    _evict_pay_link(link_id)
@@ -1,8 +1,10 @@
+import asyncio
+import time
 from http import HTTPStatus
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 from fastapi import Query, Request
-from lnurl import LnurlErrorResponse, LnurlPayActionResponse, LnurlPayResponse
+from lnurl import LnurlErrorResponse, LnurlPayActionResponse
 from starlette.exceptions import HTTPException
 
 from lnbits.core.services import create_invoice
@@ -13,6 +15,37 @@ from .crud import (
     get_or_create_lnurlp_settings,
     increment_pay_link,
 )
+from .models import PayLink
+
+
+# fiat rates come from a remote API, reuse them for a little while
+_rate_cache: Dict[str, Tuple[float, float]] = {}
+_rate_cache_ttl = 30
+_rate_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _cached_rate(currency: str) -> Optional[float]:
+    cached = _rate_cache.get(currency)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+async def _fiat_rate(link: PayLink) -> float:
+    if not link.currency:
+        return 1
+    rate = _cached_rate(link.currency)
+    if rate is not None:
+        return rate
+
+    # only one request per currency goes out when the cached rate expires,
+    # the others wait for it and pick up the fresh value
+    async with _rate_locks.setdefault(link.currency, asyncio.Lock()):
+        rate = _cached_rate(link.currency)
+        if rate is None:
+            rate = await get_fiat_rate_satoshis(link.currency)
+            _rate_cache[link.currency] = (rate, time.monotonic() + _rate_cache_ttl)
+    return rate
 
 
 @lnurlp_ext.get(
@@ -31,17 +64,15 @@ async def api_lnurl_callback(
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Pay link does not exist."
         )
-    min, max = link.min, link.max
-    rate = await get_fiat_rate_satoshis(link.currency) if link.currency else 1
+    rate = await _fiat_rate(link)
     if link.currency:
         # allow some fluctuation (as the fiat price may have changed between the calls)
         min = rate * 995 * link.min
         max = rate * 1010 * link.max
     else:
-        min = link.min * 1000
-        max = link.max * 1000
+        min = link.min_msat
+        max = link.max_msat
 
-    amount = amount
     if amount < min:
         return LnurlErrorResponse(
             reason=f"Amount {amount} is smaller than minimum {min}."
@@ -91,7 +122,7 @@ async def api_lnurl_callback(
 
     payment_hash, payment_request = await create_invoice(
         wallet_id=link.wallet,
-        amount=int(amount / 1000),
+        amount=amount // 1000,
         memo=link.description,
         unhashed_description=unhashed_description,
         extra=extra,
@@ -127,10 +158,8 @@ async def api_lnurl_response(
             status_code=HTTPStatus.NOT_FOUND, detail="Pay link does not exist."
         )
 
-    rate = await get_fiat_rate_satoshis(link.currency) if link.currency else 1
+    rate = await _fiat_rate(link)
     url = request.url_for("lnurlp.api_lnurl_callback", link_id=link.id)
-    if webhook_data:
-        url = url.include_query_params(webhook_data=webhook_data)
 
     if link.domain:
         url = url.replace(
@@ -141,13 +170,20 @@ async def api_lnurl_response(
     else:
         link.domain = request.url.netloc
 
-    resp = LnurlPayResponse(
-        callback=str(url),
-        min_sendable=round(link.min * rate) * 1000,  # type: ignore
-        max_sendable=round(link.max * rate) * 1000,  # type: ignore
-        metadata=link.lnurlpay_metadata,
-    )
-    params = resp.dict()
+    if link.currency:
+        min_sendable = round(link.min * rate) * 1000
+        max_sendable = round(link.max * rate) * 1000
+    else:
+        min_sendable, max_sendable = link.min_msat, link.max_msat
+
+    try:
+        params = link.lnurlpay_response(str(url), min_sendable, max_sendable)
+    except ValueError as exc:
+        return LnurlErrorResponse(reason=str(exc)).dict()
+
+    if webhook_data:
+        # caller-controlled, so it stays out of the cached response template
+        params["callback"] = str(url.include_query_params(webhook_data=webhook_data))
 
     if link.comment_chars > 0:
         params["commentAllowed"] = link.comment_chars
@@ -1,3 +1,6 @@
+from loguru import logger
+
+
 async def m001_initial(db):
     """
     Initial pay table.
@@ -179,3 +182,57 @@ async def m010_add_domain_column(db):
     Add domain to settings table
     """
     await db.execute("ALTER TABLE lnurlp.settings ADD COLUMN domain TEXT;")
+
+
+async def m011_unique_username_index(db):
+    """
+    Enforce unique lightning address usernames at the database level.
+    Usernames shared by several links (possible with the old check-then-insert)
+    have no defensible owner, so they are cleared on all of those links and
+    every cleared link is logged.
+    """
+    await db.execute(
+        "UPDATE lnurlp.pay_links SET username = NULL WHERE username = '';"
+    )
+    duplicates = """
+        SELECT username FROM lnurlp.pay_links
+        WHERE username IS NOT NULL GROUP BY username HAVING COUNT(*) > 1
+    """
+    for row in await db.fetchall(
+        f"SELECT id, username FROM lnurlp.pay_links WHERE username IN ({duplicates})"
+    ):
+        logger.warning(
+            f"lnurlp: clearing duplicate username '{row[1]}' from pay link {row[0]}"
+        )
+    await db.execute(
+        f"UPDATE lnurlp.pay_links SET username = NULL WHERE username IN ({duplicates})"
+    )
+    # sqlite expects the schema on the index name, postgres on the table name
+    if db.type != "SQLITE":
+        await db.execute(
+            """
+            CREATE UNIQUE INDEX pay_links_username_idx
+            ON lnurlp.pay_links (username) WHERE username IS NOT NULL;
+            """
+        )
+    else:
+        await db.execute(
+            """
+            CREATE UNIQUE INDEX lnurlp.pay_links_username_idx
+            ON pay_links (username) WHERE username IS NOT NULL;
+            """
+        )
+
+
+async def m012_wallet_index(db):
+    """
+    Index pay links by wallet for the links listing
+    """
+    if db.type != "SQLITE":
+        await db.execute(
+            "CREATE INDEX pay_links_wallet_idx ON lnurlp.pay_links (wallet);"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX lnurlp.pay_links_wallet_idx ON pay_links (wallet);"
+        )
@@ -1,12 +1,14 @@
 import json
+from functools import lru_cache
 from sqlite3 import Row
 from typing import Dict, Optional
 from urllib.parse import ParseResult, urlparse, urlunparse
 
 from fastapi import Request
 from fastapi.param_functions import Query
+from lnurl import LnurlPayResponse
 from lnurl.types import LnurlPayMetadata
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from lnbits.lnurl import encode as lnurl_encode
 
@@ -63,6 +65,10 @@ class PayLink(BaseModel):
     comment_chars: int
     max: float
     fiat_base_multiplier: int
+    # bounds in millisatoshis, only known upfront for satoshi links.
+    # private so they stay out of the API responses
+    _min_msat: Optional[int] = PrivateAttr(default=None)
+    _max_msat: Optional[int] = PrivateAttr(default=None)
 
     @classmethod
     def from_row(cls, row: Row) -> "PayLink":
@@ -70,7 +76,19 @@ class PayLink(BaseModel):
         if data["currency"] and data["fiat_base_multiplier"]:
             data["min"] /= data["fiat_base_multiplier"]
             data["max"] /= data["fiat_base_multiplier"]
-        return cls(**data)
+        link = cls(**data)
+        if not link.currency:
+            link._min_msat = round(link.min * 1000)
+            link._max_msat = round(link.max * 1000)
+        return link
+
+    @property
+    def min_msat(self) -> Optional[int]:
+        return self._min_msat
+
+    @property
+    def max_msat(self) -> Optional[int]:
+        return self._max_msat
 
     def lnurl(self, req: Request) -> str:
         url = req.url_for("lnurlp.api_lnurl_response", link_id=self.id)
@@ -80,14 +98,12 @@ class PayLink(BaseModel):
                 port=None,
                 scheme="http" if self.domain.endswith(".onion") else "https"
             )
-        url = str(url)
 
         # Check if url is .onion and change to http
-        if urlparse(url).netloc.endswith(".onion"):
-            # change url string scheme to http
-            url = url.replace("https://", "http://")
+        if url.netloc.endswith(".onion"):
+            url = url.replace(scheme="http")
 
-        return lnurl_encode(url)
+        return lnurl_encode(str(url))
 
     def success_action(self, payment_hash: str) -> Optional[Dict]:
         if self.success_url:
@@ -107,11 +123,48 @@ class PayLink(BaseModel):
 
     @property
     def lnurlpay_metadata(self) -> LnurlPayMetadata:
-        if self.domain and self.username:
-            text = f"Payment to {self.username}"
-            identifier = f"{self.username}@{self.domain}"
-            metadata = [["text/plain", text], ["text/identifier", identifier]]
-        else:
-            metadata = [["text/plain", self.description]]
-
-        return LnurlPayMetadata(json.dumps(metadata))
+        return _lnurlpay_metadata(self.description, self.username, self.domain)
+
+    def lnurlpay_response(
+        self, callback: str, min_sendable: int, max_sendable: int
+    ) -> Dict:
+        # the cached template was validated with placeholder amounts
+        if min_sendable <= 0:
+            raise ValueError(f"Minimum amount {min_sendable} must be positive.")
+        if max_sendable < min_sendable:
+            raise ValueError(
+                f"Maximum amount {max_sendable} is smaller than minimum {min_sendable}."
+            )
+        return {
+            **_lnurlpay_response_template(callback, self.lnurlpay_metadata),
+            "minSendable": min_sendable,
+            "maxSendable": max_sendable,
+        }
+
+
+# keyed by every field the metadata depends on, so edits to a link never hit
+# a stale entry and no explicit invalidation is needed
+@lru_cache(maxsize=1024)
+def _lnurlpay_metadata(
+    description: str, username: Optional[str], domain: Optional[str]
+) -> LnurlPayMetadata:
+    if domain and username:
+        text = f"Payment to {username}"
+        identifier = f"{username}@{domain}"
+        metadata = [["text/plain", text], ["text/identifier", identifier]]
+    else:
+        metadata = [["text/plain", description]]
+
+    return LnurlPayMetadata(json.dumps(metadata))
+
+
+# the validated response only varies in its amounts between requests for the
+# same link, build it once and let lnurlpay_response patch the amounts in
+@lru_cache(maxsize=1024)
+def _lnurlpay_response_template(callback: str, metadata: LnurlPayMetadata) -> Dict:
+    return LnurlPayResponse(
+        callback=callback,
+        min_sendable=1000,  # type: ignore
+        max_sendable=1000,  # type: ignore
+        metadata=metadata,
+    ).dict()
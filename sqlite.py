@@ -0,0 +1,147 @@
+import asyncio
+import sqlite3
+from typing import Any, Callable, List, Optional, Sequence, Set
+from urllib.parse import quote
+
+from loguru import logger
+
+from . import db
+
+
+async def enable_wal() -> None:
+    if db.type != "SQLITE":
+        return
+    # journal_mode is persisted in the database file, so switching it once
+    # applies to every connection lnbits opens afterwards. Readers then no
+    # longer block behind the writer incrementing the served counters.
+    try:
+        await db.execute("PRAGMA lnurlp.journal_mode = WAL;")
+    except Exception as exc:
+        logger.error(f"lnurlp: could not enable WAL mode: {exc}")
+
+
+_enable_wal_task: Optional[asyncio.Task] = None
+
+
+def start_enable_wal() -> None:
+    # keep a reference so the one-shot task isn't garbage collected midway
+    global _enable_wal_task
+    _enable_wal_task = asyncio.create_task(enable_wal())
+
+
+class ReadPool:
+    """
+    A few read-only connections to the extension's SQLite file, used for the
+    hot SELECTs so they don't queue behind lnbits' single database lock.
+    Writes keep going through `db`.
+    """
+
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self.closed = False
+        self.slots = asyncio.Semaphore(size)
+        self.idle: List[sqlite3.Connection] = []
+        # every open connection, idle or checked out
+        self.connections: Set[sqlite3.Connection] = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(":memory:", uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # attached under the same schema name lnbits uses, so queries are shared
+        conn.execute(
+            "ATTACH DATABASE ? AS lnurlp", (f"file:{quote(self.path)}?mode=ro",)
+        )
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA lnurlp.cache_size = -64000;")
+        conn.execute("PRAGMA lnurlp.mmap_size = 268435456;")
+        return conn
+
+    async def _acquire(self) -> sqlite3.Connection:
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop()
+        future = asyncio.ensure_future(asyncio.to_thread(self._connect))
+        try:
+            conn = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the thread keeps connecting, adopt its connection once it is done
+            future.add_done_callback(self._adopt)
+            raise
+        except BaseException:
+            self.slots.release()
+            raise
+        self.connections.add(conn)
+        return conn
+
+    def _adopt(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and not future.exception():
+            conn = future.result()
+            if self.closed:
+                conn.close()
+            else:
+                self.connections.add(conn)
+                self.idle.append(conn)
+        self.slots.release()
+
+    def _release(self, conn: sqlite3.Connection, future: asyncio.Future) -> None:
+        # a connection that failed may be in a bad state, don't hand it out again
+        if self.closed or future.cancelled() or future.exception():
+            self.connections.discard(conn)
+            conn.close()
+        else:
+            self.idle.append(conn)
+        self.slots.release()
+
+    async def _run(self, query: str, values: Sequence[Any], fetch: Callable) -> Any:
+        conn = await self._acquire()
+        future = asyncio.ensure_future(
+            asyncio.to_thread(lambda: fetch(conn.execute(query, values)))
+        )
+        # the connection only goes back once the worker thread is done with it,
+        # even if the caller gets cancelled while the query is running
+        future.add_done_callback(lambda done: self._release(conn, done))
+        return await asyncio.shield(future)
+
+    async def fetchall(self, query: str, values: Sequence[Any] = ()) -> List[Any]:
+        return await self._run(query, values, sqlite3.Cursor.fetchall)
+
+    async def fetchone(self, query: str, values: Sequence[Any] = ()) -> Optional[Any]:
+        return await self._run(query, values, sqlite3.Cursor.fetchone)
+
+    def close(self) -> None:
+        # idle connections are closed now, checked out ones as soon as their
+        # query finishes and they are released
+        self.closed = True
+        for conn in self.idle:
+            self.connections.discard(conn)
+            conn.close()
+        self.idle.clear()
+
+
+_read_pool: Optional[ReadPool] = None
+
+
+def _get_read_pool() -> ReadPool:
+    global _read_pool
+    if not _read_pool:
+        _read_pool = ReadPool(db.path)
+    return _read_pool
+
+
+async def read_fetchone(query: str, values: Sequence[Any] = ()) -> Optional[Any]:
+    if db.type != "SQLITE":
+        return await db.fetchone(query, values)
+    return await _get_read_pool().fetchone(query, values)
+
+
+async def read_fetchall(query: str, values: Sequence[Any] = ()) -> List[Any]:
+    if db.type != "SQLITE":
+        return await db.fetchall(query, values)
+    return await _get_read_pool().fetchall(query, values)
+
+
+def close_read_pool() -> None:
+    global _read_pool
+    if _read_pool:
+        _read_pool.close()
+        _read_pool = None
@@ -13,7 +13,11 @@ from lnbits.core.models import Payment
 from lnbits.helpers import get_current_extension_name
 from lnbits.tasks import register_invoice_listener
 
-from .crud import get_or_create_lnurlp_settings, get_pay_link
+from .crud import (
+    flush_pay_link_increments,
+    get_or_create_lnurlp_settings,
+    get_pay_link,
+)
 from .models import PayLink
 from .nostr.event import Event
 
@@ -27,6 +31,17 @@ async def wait_for_paid_invoices():
         await on_invoice_paid(payment)
 
 
+async def flush_pay_link_counters():
+    try:
+        while True:
+            await asyncio.sleep(0.1)
+            await flush_pay_link_increments()
+    except asyncio.CancelledError:
+        # flush once more on shutdown so pending counters aren't lost
+        await flush_pay_link_increments()
+        raise
+
+
 async def on_invoice_paid(payment: Payment):
     if payment.extra.get("tag") != "lnurlp":
         return
@@ -169,4 +184,5 @@ async def send_zap(payment: Payment):
     for ws, wst in zip(wss, wsts):
         logger.debug(f"Closing websocket {ws.url}")
         ws.close()
-        wst.join()
+        # joining waits for the websocket thread to wind down, keep it off the loop
+        await asyncio.to_thread(wst.join)
@@ -18,7 +18,6 @@ from .crud import (
     get_address_data,
     get_or_create_lnurlp_settings,
     get_pay_link,
-    get_pay_link_by_username,
     get_pay_links,
     update_lnurlp_settings,
     update_pay_link,
@@ -89,7 +88,7 @@ async def api_link_retrieve(
 
 
 async def check_username_exists(username: str):
-    prev_link = await get_pay_link_by_username(username)
+    prev_link = await get_address_data(username)
     if prev_link:
         raise HTTPException(
             detail="Username already taken.",
@@ -153,6 +152,9 @@ async def api_link_create_or_update(
             raise HTTPException(
                 detail=f"Invalid username: {ex}", status_code=HTTPStatus.BAD_REQUEST
             )
+    else:
+        # empty usernames would collide on the unique username index
+        data.username = None
 
     # if wallet is not provided, use the wallet of the key
     if not data.wallet:
@@ -182,10 +184,12 @@ async def api_link_create_or_update(
 
         link = await update_pay_link(**data.dict(), link_id=link_id)
     else:
-        if data.username:
-            await check_username_exists(data.username)
-
         link = await create_pay_link(data)
+        if not link:
+            raise HTTPException(
+                detail="Username already taken.",
+                status_code=HTTPStatus.BAD_REQUEST,
+            )
 
     assert link
     return {**link.dict(), "lnurl": link.lnurl(request)}